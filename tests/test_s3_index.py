@@ -0,0 +1,286 @@
+import datetime
+from functools import partial
+from io import BytesIO
+
+import pytest
+from tornado import gen
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
+
+from tornado_s3 import S3Bucket, S3Error, S3Index, S3Listing
+from tornado_s3.s3_index import _prefix_range
+
+listing_tmpl = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                '<IsTruncated>%s</IsTruncated>%s</ListBucketResult>')
+entry_tmpl = ('<Contents><Key>%s</Key><LastModified>2020-01-01T00:00:00.000Z</LastModified>'
+              '<ETag>"%s"</ETag><Size>%d</Size></Contents>')
+
+
+def make_listing(entries, truncated=False):
+    contents = "".join(entry_tmpl % (key, "etag-" + key, size) for key, size in entries)
+    return (listing_tmpl % (str(truncated).lower(), contents)).encode("utf-8")
+
+
+def make_response(code, body=b"", headers=None):
+    return HTTPResponse(HTTPRequest("http://s3.example/bucket"), code,
+                        headers=HTTPHeaders(headers or {}), buffer=BytesIO(body))
+
+
+def run(func, *a, **k):
+    loop = IOLoop()
+    try:
+        return loop.run_sync(partial(func, *a, **k))
+    finally:
+        loop.close()
+
+
+class FakeS3(object):
+    """Serves a bucket from a dict of key -> size in place of `S3Bucket.send`."""
+
+    def __init__(self, bucket, objects=None, page_size=2):
+        self.objects = dict(objects or {})
+        self.page_size = page_size
+        self.requests = []
+        self.fail = None
+        # Coroutine run with each listing request once its page is computed.
+        self.on_listing = None
+        bucket.send = self.send
+
+    @gen.coroutine
+    def send(self, s3req, callback=None):
+        self.requests.append(s3req)
+        if self.fail is not None:
+            return make_response(self.fail, b"<html>error</html>")
+        if s3req.method == "PUT":
+            self.objects[s3req.key] = len(s3req.data)
+            return make_response(200, headers={"Date": "Wed, 01 Jan 2020 10:00:00 GMT",
+                                               "ETag": '"server-etag"'})
+        if s3req.method == "DELETE":
+            self.objects.pop(s3req.key, None)
+            return make_response(204)
+        args = s3req.args
+        keys = sorted(k for k in self.objects
+                      if k.startswith(args.get("prefix", "")) and k > args.get("marker", ""))
+        page = keys[:self.page_size]
+        body = make_listing([(k, self.objects[k]) for k in page],
+                            truncated=len(keys) > len(page))
+        if self.on_listing is not None:
+            yield self.on_listing(s3req)
+        return make_response(200, body)
+
+
+@pytest.fixture
+def index():
+    idx = S3Index()
+    yield idx
+    idx.close()
+
+
+def test_prefix_range():
+    assert _prefix_range(None) == ("", None)
+    assert _prefix_range("a/") == ("a/", "a0")
+    assert _prefix_range("a\U0010ffff") == ("a\U0010ffff", "b")
+    assert _prefix_range("\U0010ffff") == ("\U0010ffff", None)
+    low, high = _prefix_range("a\ud7ff")
+    assert high == "a\ue000"
+    high.encode("utf-8")
+
+
+def test_prefix_query_below_surrogates(index):
+    index.add("a\ud7ff/x", None, None, 3)
+    index.add("a\ue000", None, None, 5)
+    assert index.count("a\ud7ff") == 1
+    assert index.total_size("a\ud7ff") == 3
+
+
+def test_update_and_queries(index):
+    listing = S3Listing.parse(BytesIO(make_listing(
+        [("a/1", 5), ("a/2", 7), ("a0", 11), ("b", 1)])))
+    assert index.update(listing) == 4
+    assert index.marker == "b"
+    assert len(index) == 4
+    assert "a/2" in index and "c" not in index
+
+    assert index.count("a/") == 2
+    assert index.total_size("a/") == 12
+    assert index.total_size() == 24
+    assert index.count("z") == 0
+    assert index.total_size("z") == 0
+
+    assert [e[0] for e in index.listdir("a")] == ["a/1", "a/2", "a0"]
+    assert [e[0] for e in index.listdir(marker="a/1", limit=2)] == ["a/2", "a0"]
+    assert index.listdir("a/", limit=1) == [
+        ("a/1", datetime.datetime(2020, 1, 1), '"etag-a/1"', 5)]
+
+
+def test_update_ignores_other_prefixes():
+    idx = S3Index(prefix="a/")
+    listing = S3Listing.parse(BytesIO(make_listing([("a/1", 5), ("a/2", 7), ("b", 1)])))
+    assert idx.update(listing) == 2
+    assert idx.marker == "a/2"
+    assert [e[0] for e in idx.listdir()] == ["a/1", "a/2"]
+
+    listing = S3Listing.parse(BytesIO(make_listing([("c", 1)])))
+    assert idx.update(listing) == 0
+    assert idx.marker == "a/2"
+    assert len(idx) == 2
+
+
+def test_refresh_resumes_from_marker(index):
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2, "k3": 3, "k4": 4, "k5": 5})
+
+    assert run(index.refresh, bucket) == 5
+    assert [r.args.get("marker") for r in s3.requests] == [None, "k2", "k4"]
+    assert index.marker == "k5"
+    assert index.total_size() == 15
+
+    s3.requests = []
+    s3.objects["k6"] = 6
+    assert run(index.refresh, bucket) == 1
+    assert [r.args.get("marker") for r in s3.requests] == ["k5"]
+    assert index.count() == 6
+
+
+def test_refresh_with_prefix():
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"a/1": 1, "a/2": 2, "b/1": 4})
+    idx = S3Index(prefix="a/")
+    assert run(idx.refresh, bucket) == 2
+    assert all(r.args["prefix"] == "a/" for r in s3.requests)
+    assert [e[0] for e in idx.listdir()] == ["a/1", "a/2"]
+
+
+def test_refresh_error(index):
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"k1": 1})
+    s3.fail = 404
+    with pytest.raises(S3Error) as excinfo:
+        run(index.refresh, bucket)
+    assert excinfo.value.code == 404
+    assert excinfo.value.extra["bucket"] == "bucket"
+
+
+def test_full_refresh_failure_keeps_index(index):
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2, "k3": 3})
+    run(index.refresh, bucket)
+
+    calls = []
+
+    @gen.coroutine
+    def failing_send(s3req, callback=None):
+        calls.append(s3req)
+        if len(calls) > 1:
+            return make_response(500)
+        result = yield FakeS3.send(s3, s3req)
+        return result
+    bucket.send = failing_send
+
+    with pytest.raises(S3Error):
+        run(index.refresh, bucket, full=True)
+    assert index.count() == 3
+    assert index.marker == "k3"
+
+
+def test_full_refresh_drops_stale_keys(index):
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2, "k3": 3})
+    run(index.refresh, bucket)
+    del s3.objects["k1"]
+
+    assert run(index.refresh, bucket) == 0
+    assert "k1" in index
+    assert run(index.refresh, bucket, full=True) == 2
+    assert [e[0] for e in index.listdir()] == ["k2", "k3"]
+    assert index.marker == "k3"
+
+
+def test_full_refresh_keeps_put_delete_between_pages(index):
+    bucket = S3Bucket("bucket", index=index)
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2, "k3": 3, "k4": 4})
+    run(index.refresh, bucket)
+
+    @gen.coroutine
+    def interleave(s3req):
+        if s3req.args.get("marker") == "k2":
+            s3.on_listing = None
+            yield bucket.delete("k1")
+            yield bucket.put("k0", "data")
+    s3.on_listing = interleave
+
+    run(index.refresh, bucket, full=True)
+    assert [e[0] for e in index.listdir()] == ["k0", "k2", "k3", "k4"]
+    assert sorted(s3.objects) == ["k0", "k2", "k3", "k4"]
+    assert index.total_size() == 4 + 2 + 3 + 4
+
+
+def test_refresh_skips_keys_deleted_while_listing(index):
+    bucket = S3Bucket("bucket", index=index)
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2})
+
+    @gen.coroutine
+    def interleave(s3req):
+        s3.on_listing = None
+        yield bucket.delete("k1")
+    s3.on_listing = interleave
+
+    assert run(index.refresh, bucket) == 1
+    assert [e[0] for e in index.listdir()] == ["k2"]
+    assert index.marker == "k2"
+
+
+def test_concurrent_refresh_raises(index):
+    bucket = S3Bucket("bucket")
+    s3 = FakeS3(bucket, {"k1": 1, "k2": 2, "k3": 3})
+    errors = []
+
+    @gen.coroutine
+    def interleave(s3req):
+        s3.on_listing = None
+        try:
+            yield index.refresh(bucket, full=True)
+        except RuntimeError as e:
+            errors.append(e)
+    s3.on_listing = interleave
+
+    assert run(index.refresh, bucket, full=True) == 3
+    assert len(errors) == 1
+    assert [e[0] for e in index.listdir()] == ["k1", "k2", "k3"]
+
+
+def test_prefix_bound_to_file(tmp_path):
+    path = str(tmp_path / "index.db")
+    S3Index(path, prefix="a/").close()
+    S3Index(path, prefix="a/").close()
+    with pytest.raises(ValueError):
+        S3Index(path, prefix="b/")
+    with pytest.raises(ValueError):
+        S3Index(path)
+
+
+def test_put_delete_update_index(index):
+    bucket = S3Bucket("bucket", index=index)
+    s3 = FakeS3(bucket)
+
+    run(bucket.put, "a/1", "hello")
+    assert s3.objects == {"a/1": 5}
+    assert index.listdir() == [
+        ("a/1", datetime.datetime(2020, 1, 1, 10, 0), '"server-etag"', 5)]
+
+    run(bucket.delete, "a/1")
+    assert s3.objects == {}
+    assert "a/1" not in index
+
+
+def test_failed_put_delete_leave_index(index):
+    bucket = S3Bucket("bucket", index=index)
+    s3 = FakeS3(bucket)
+    run(bucket.put, "a/1", "hello")
+
+    s3.fail = 403
+    run(bucket.put, "a/2", "hello")
+    run(bucket.delete, "a/1")
+    assert [e[0] for e in index.listdir()] == ["a/1"]
@@ -4,8 +4,9 @@ from tornado_s3.exceptions.s3_error import S3Error
 from tornado_s3.exceptions.key_exceptions import KeyNotFound
 from .s3_bucket import S3Bucket
 from .s3_file import S3File
+from .s3_index import S3Index
 from .s3_listing import S3Listing
 from .s3_request import S3Request
 
-S3File, S3Bucket, S3Error, KeyNotFound  # pyflakes
-__all__ = "S3File", "S3Bucket", "S3Error"
+S3File, S3Bucket, S3Error, KeyNotFound, S3Index  # pyflakes
+__all__ = "S3File", "S3Bucket", "S3Error", "S3Index"
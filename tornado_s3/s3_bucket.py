@@ -22,7 +22,7 @@ class S3Bucket(object):
     n_retries = 10
 
     def __init__(self, name, access_key=None, secret_key=None,
-                 base_url=None, timeout=None, secure=False):
+                 base_url=None, timeout=None, secure=False, index=None):
         scheme = ("http", "https")[int(bool(secure))]
         if not base_url:
             base_url = "%s://%s/%s" % (scheme, amazon_s3_domain, aws_urlquote(name))
@@ -36,6 +36,7 @@ class S3Bucket(object):
         self.secret_key = secret_key
         self.base_url = base_url
         self.timeout = timeout
+        self.index = index
 
     def __str__(self):
         return "<%s %s at %r>" % (self.__class__.__name__, self.name, self.base_url)
@@ -124,17 +125,25 @@ class S3Bucket(object):
 
         s3req = self.request(method="PUT", key=key, data=data, headers=headers)
         result = yield self.send(s3req, partial(self._put, callback=callback))
+        if self.index is not None and result is not None and 200 <= result.code < 300:
+            self.index.add_put(key, int(headers["Content-Length"]), result)
         return result
 
     def _delete(self, response, callback):
         success = 200 <= response.code < 300
         if callback: callback(success)
 
+    @gen.coroutine
     def delete(self, key, callback=None):
         try:
-            self.send(self.request(method="DELETE", key=key), partial(self._delete, callback=callback))
+            result = yield self.send(self.request(method="DELETE", key=key),
+                                     partial(self._delete, callback=callback))
         except KeyNotFound as e:
             e.fp.close()
+            return
+        if self.index is not None and result is not None and 200 <= result.code < 300:
+            self.index.discard(key)
+        return result
 
     def _listing(self, response, result, args, callback):
         listing = S3Listing.parse(response.buffer)
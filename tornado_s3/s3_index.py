@@ -0,0 +1,293 @@
+"""Local persistent index of bucket keys"""
+
+import datetime
+import sqlite3
+from email.utils import parsedate_to_datetime
+
+from tornado import gen
+
+from .exceptions.s3_error import S3Error
+from .s3_listing import S3Listing
+from .utils import iso8601_fmt, _iso8601_dt
+
+
+def _utc_parsedate(v):
+    """Parse an RFC 822 date into a naive UTC datetime, as listings use.
+
+    >>> _utc_parsedate("Wed, 01 Jan 2020 10:00:00 GMT")
+    datetime.datetime(2020, 1, 1, 10, 0)
+    """
+    dt = parsedate_to_datetime(v)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=0)
+
+
+def _prefix_range(prefix):
+    """Compute the half-open key range ``[low, high)`` matching *prefix*.
+
+    *high* is None when the range is unbounded above.
+
+    >>> _prefix_range("photos/")
+    ('photos/', 'photos0')
+    >>> _prefix_range("")
+    ('', None)
+    >>> _prefix_range("a\ud7ff")
+    ('a\ud7ff', 'a\ue000')
+    """
+    low = prefix or ""
+    high = low.rstrip(chr(0x10ffff))
+    if not high:
+        return low, None
+    # Surrogates can't be encoded to UTF-8 and never occur in keys.
+    succ = ord(high[-1]) + 1
+    if 0xd800 <= succ <= 0xdfff:
+        succ = 0xe000
+    return low, high[:-1] + chr(succ)
+
+
+class S3Index(object):
+    """SQLite-backed index of the keys of a bucket.
+
+    The index is populated from `S3Listing` pages by `refresh`, which resumes
+    from the last marker it stored, so repeated refreshes only fetch keys
+    lexicographically after the ones already indexed. Keys added before the
+    marker or removed by other clients are only picked up by a full refresh.
+
+    A bucket created with ``S3Bucket(..., index=S3Index(path))`` keeps the
+    index up to date with its own `put` and `delete` calls, including those
+    made while a refresh is in progress.
+
+    *prefix*, if given, restricts the index to keys starting with it. An index
+    file is bound to the prefix it was first opened with.
+    """
+
+    page_size = 1000
+
+    # Keys added or discarded while a refresh is running, mapped to their row
+    # (None for discarded keys); they take precedence over listing pages.
+    _journal = None
+
+    _keys_schema = """
+        CREATE TABLE IF NOT EXISTS %s (
+            key TEXT PRIMARY KEY,
+            modified TEXT,
+            etag TEXT,
+            size INTEGER NOT NULL
+        )"""
+
+    def __init__(self, path=":memory:", prefix=None):
+        self.path = path
+        self.prefix = prefix or ""
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self._keys_schema % "keys" + """;
+            CREATE TABLE IF NOT EXISTS state (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        row = self.db.execute("SELECT value FROM state WHERE name = 'prefix'").fetchone()
+        if row is None:
+            with self.db:
+                self.db.execute("INSERT INTO state (name, value) VALUES ('prefix', ?)",
+                                (self.prefix,))
+        elif row[0] != self.prefix:
+            self.db.close()
+            raise ValueError("index %r was built for prefix %r, not %r"
+                             % (path, row[0], self.prefix))
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(%r, prefix=%r)" % (self.path, self.prefix)
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, key):
+        row = self.db.execute("SELECT 1 FROM keys WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def close(self):
+        self.db.close()
+
+    @property
+    def marker(self):
+        row = self.db.execute("SELECT value FROM state WHERE name = 'marker'").fetchone()
+        return row[0] if row else None
+
+    def _set_marker(self, marker):
+        self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('marker', ?)",
+                        (marker,))
+
+    def _where(self, prefix, marker=None):
+        low, high = _prefix_range(prefix)
+        clauses, params = ["key >= ?"], [low]
+        if high is not None:
+            clauses.append("key < ?")
+            params.append(high)
+        if marker is not None:
+            clauses.append("key > ?")
+            params.append(marker)
+        return " AND ".join(clauses), params
+
+    def _row(self, key, modified, etag, size):
+        if modified is not None:
+            modified = modified.strftime(iso8601_fmt)
+        return key, modified, etag, size
+
+    def add(self, key, modified, etag, size):
+        """Record *key* as a ``(key, modified, etag, size)`` entry."""
+        if not key.startswith(self.prefix):
+            return
+        row = self._row(key, modified, etag, size)
+        if self._journal is not None:
+            self._journal[key] = row
+        with self.db:
+            self._insert("keys", [row])
+
+    def add_put(self, key, size, response):
+        """Record a successful PUT of *size* bytes to *key*.
+
+        The modification date and ETag are taken from the S3 *response*, so
+        they agree with what a later listing reports.
+        """
+        modified = response.headers.get("Date")
+        if modified is not None:
+            modified = _utc_parsedate(modified)
+        self.add(key, modified, response.headers.get("ETag"), size)
+
+    def discard(self, key):
+        """Forget *key*, if it is indexed."""
+        if self._journal is not None:
+            self._journal[key] = None
+        with self.db:
+            self.db.execute("DELETE FROM keys WHERE key = ?", (key,))
+
+    def clear(self):
+        """Drop every indexed key along with the stored marker."""
+        self.db.execute("DELETE FROM keys")
+        self.db.execute("DELETE FROM state WHERE name = 'marker'")
+        self.db.commit()
+
+    def _insert(self, table, rows):
+        self.db.executemany("INSERT OR REPLACE INTO %s (key, modified, etag, size) "
+                            "VALUES (?, ?, ?, ?)" % table, rows)
+
+    def _store(self, listing, table="keys"):
+        """Store the entries of *listing* matching the prefix into *table*.
+
+        Keys in the journal are skipped. The marker is only advanced when
+        storing into ``keys``. Returns the number of entries stored and the
+        last matching key of the page, if any.
+        """
+        rows = [self._row(*item) for item in listing if item[0].startswith(self.prefix)]
+        last = rows[-1][0] if rows else None
+        if self._journal:
+            rows = [row for row in rows if row[0] not in self._journal]
+        with self.db:
+            self._insert(table, rows)
+            if table == "keys" and last is not None:
+                self._set_marker(last)
+        return len(rows), last
+
+    def update(self, listing):
+        """Store the entries of an `S3Listing` page and advance the marker.
+
+        Entries outside the index prefix are ignored. Returns the number of
+        entries stored.
+        """
+        return self._store(listing)[0]
+
+    @gen.coroutine
+    def _fetch_page(self, bucket, marker):
+        args = {"max-keys": str(self.page_size)}
+        if self.prefix:
+            args["prefix"] = self.prefix
+        if marker is not None:
+            args["marker"] = marker
+        response = yield bucket.send(bucket.request(args=args))
+        if response is None or not 200 <= response.code < 300:
+            raise S3Error("listing failed", bucket=bucket.name, marker=marker,
+                          code=getattr(response, "code", None))
+        return S3Listing.parse(response.buffer)
+
+    @gen.coroutine
+    def refresh(self, bucket, full=False):
+        """Fetch the listing pages of *bucket* not indexed yet.
+
+        Resumes after the stored marker; *full* lists the whole bucket again
+        into a staging table which replaces the index only once the last page
+        has been fetched, so a failed rebuild leaves the old index intact.
+
+        Keys put or deleted through `add` and `discard` while the refresh runs
+        keep their local state rather than the one of a possibly stale page.
+        Only one refresh may run at a time.
+
+        Returns the number of entries fetched.
+        """
+        if self._journal is not None:
+            raise RuntimeError("%r is already being refreshed" % self)
+        self._journal = {}
+        try:
+            n_fetched = yield self._refresh(bucket, full)
+        finally:
+            self._journal = None
+        return n_fetched
+
+    @gen.coroutine
+    def _refresh(self, bucket, full):
+        if full:
+            with self.db:
+                self.db.execute("DROP TABLE IF EXISTS keys_rebuild")
+                self.db.execute(self._keys_schema % "keys_rebuild")
+            marker = None
+        else:
+            marker = self.marker
+        n_fetched = 0
+        while True:
+            listing = yield self._fetch_page(bucket, marker)
+            n_stored, last = self._store(listing, ("keys", "keys_rebuild")[full])
+            n_fetched += n_stored
+            if last is not None:
+                marker = last
+            if not listing.truncated or last is None:
+                break
+        if full:
+            with self.db:
+                self.db.execute("DELETE FROM keys")
+                self.db.execute("INSERT INTO keys SELECT * FROM keys_rebuild")
+                self.db.execute("DROP TABLE keys_rebuild")
+                for key, row in self._journal.items():
+                    if row is None:
+                        self.db.execute("DELETE FROM keys WHERE key = ?", (key,))
+                    else:
+                        self._insert("keys", [row])
+                self._set_marker(marker)
+        return n_fetched
+
+    def listdir(self, prefix=None, marker=None, limit=None):
+        """List indexed keys, mirroring `S3Bucket.listdir`.
+
+        Returns tuples of (key, modified, etag, size), ordered by key.
+        """
+        where, params = self._where(prefix, marker)
+        sql = "SELECT key, modified, etag, size FROM keys WHERE %s ORDER BY key" % where
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        rv = []
+        for key, modified, etag, size in self.db.execute(sql, params):
+            if modified is not None:
+                modified = _iso8601_dt(modified)
+            rv.append((key, modified, etag, size))
+        return rv
+
+    def count(self, prefix=None):
+        """Count indexed keys starting with *prefix*."""
+        where, params = self._where(prefix)
+        return self.db.execute("SELECT COUNT(*) FROM keys WHERE " + where, params).fetchone()[0]
+
+    def total_size(self, prefix=None):
+        """Sum the sizes of indexed keys starting with *prefix*."""
+        where, params = self._where(prefix)
+        sql = "SELECT COALESCE(SUM(size), 0) FROM keys WHERE " + where
+        return self.db.execute(sql, params).fetchone()[0]
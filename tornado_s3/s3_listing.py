@@ -1,4 +1,7 @@
-from xml.etree import cElementTree as ElementTree
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from .utils import _iso8601_dt
 
 amazon_s3_domain = "s3.amazonaws.com"